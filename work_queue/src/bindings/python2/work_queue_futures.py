@@ -20,6 +20,8 @@ import traceback
 import concurrent.futures as futures
 import atexit
 
+from collections import deque
+
 try:
     # from py3
     import queue as ThreadQueue
@@ -27,7 +29,21 @@ except ImportError:
     # from py2
     import Queue as ThreadQueue
 
+# SimpleQueue is only available from python 3.7
+_SimpleQueue = getattr(ThreadQueue, 'SimpleQueue', ThreadQueue.Queue)
+
+# checked for every task that finishes
+_WQ_SUCCESS = work_queue.WORK_QUEUE_RESULT_SUCCESS
+
 
+# remove and return all the items currently in q, without blocking.
+def _drain(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except ThreadQueue.Empty:
+            return items
 
 
 ##
@@ -51,11 +67,25 @@ class WorkQueueFutures(object):
         self._queue_lock       = threading.Lock()
         self._stop_queue_event = threading.Event()
 
-        # set when queue is empty
-        self._join_event = threading.Event()
+        # set when tasks are submitted, wakes up _sync_loop
+        self._submit_event = threading.Event()
+
+        # True when there are no tasks to submit or waiting to be collected.
+        # Kept by _sync_loop and cleared when new tasks are submitted.
+        self._is_idle = True
+
+        # set when _is_idle becomes True, or to wake up join when the queue
+        # is stopped
+        self._idle_event = threading.Event()
+        self._idle_event.set()
 
-        self._tasks_to_submit        = ThreadQueue.Queue()
-        self._tasks_before_callbacks = ThreadQueue.Queue()
+        # FutureTasks submitted to this queue wait on this condition for
+        # their results. _callback_loop notifies it once per batch of
+        # finished tasks.
+        self._cond = threading.Condition()
+
+        self._tasks_to_submit        = _SimpleQueue()
+        self._tasks_before_callbacks = _SimpleQueue()
 
         self._sync_loop = threading.Thread(target = self._sync_loop)
         self._sync_loop.daemon  = True
@@ -77,7 +107,13 @@ class WorkQueueFutures(object):
 
 
     # methods not explicitly defined we route to synchronous WorkQueue, using a lock.
+    # Wrapped public methods are cached in the instance, so that later calls do
+    # not go through __getattr__.
     def __getattr__(self, name):
+        if name == '_queue':
+            # __init__ did not get to create the queue
+            raise AttributeError(name)
+
         attr = getattr(self._queue, name)
 
         if callable(attr):
@@ -86,6 +122,8 @@ class WorkQueueFutures(object):
                 with self._queue_lock:
                     result = attr(*args, **kwargs)
                 return result
+            if not name.startswith('_'):
+                object.__setattr__(self, name, method_wrapped)
             return method_wrapped
         else:
             return attr
@@ -96,9 +134,27 @@ class WorkQueueFutures(object):
     #
     # @param self   Reference to the current work queue object.
     # @param task   A task description created from @ref work_queue::Task.
+    # @return       The submitted task.
     def submit(self, future_task):
         if isinstance(future_task, FutureTask):
+            if self._stop_queue_event.is_set():
+                raise RuntimeError('cannot submit tasks after the queue is closed')
+            # _sync_loop checks again, as the task may be cancelled before it
+            # is submitted to the queue
+            if future_task.cancelled():
+                return future_task
+            self._is_idle = False
+            self._idle_event.clear()
             self._tasks_to_submit.put(future_task, False)
+            self._submit_event.set()
+
+            # the queue may have been closed after the check above, and
+            # _sync_loop may have already failed its tasks
+            if self._stop_queue_event.is_set():
+                self._fail_tasks(_drain(self._tasks_to_submit), exception = 'queue was closed')
+                raise RuntimeError('cannot submit tasks after the queue is closed')
+
+            return future_task
         else:
             raise TypeError("{} is not a WorkQueue.Task")
 
@@ -114,106 +170,195 @@ class WorkQueueFutures(object):
     #
     # @param self       Reference to the current work queue object.
     def empty(self):
-        if self._tasks_to_submit.empty():
-            return self._queue.empty()
+        # _is_idle is kept by _sync_loop, so we do not need to take the lock
+        # of the queue.
+        if self._is_idle and self._tasks_to_submit.empty():
+            return 1
         else:
             return 0
 
     def _callback_loop(self):
         while not self._stop_queue_event.is_set():
-
-            task = None
             try:
-                task = self._tasks_before_callbacks.get(True, 1)
-                task.set_result_or_exception()
-                self._tasks_before_callbacks.task_done()
+                batch = [self._tasks_before_callbacks.get(True, 1)]
             except ThreadQueue.Empty:
-                pass
-            except Exception as e:
-                err = traceback.format_exc()
-                if task:
-                    task.set_exception(FutureTaskError(t, err))
-                else:
-                    print(err)
+                continue
+            batch.extend(_drain(self._tasks_before_callbacks))
+
+            # all the tasks in the batch are marked done with a single
+            # notify, and their callbacks are invoked after waking up the
+            # waiters.
+            completed = []
+            failed    = []
+            with self._cond:
+                for task in batch:
+                    try:
+                        completed.append((task, task._complete()))
+                    except Exception as e:
+                        failed.append((task, sys.exc_info()))
+                self._cond.notify_all()
+
+            for (task, callbacks) in completed:
+                task._run_callbacks(callbacks)
+
+            for (task, exc_info) in failed:
+                task.set_exception(FutureTaskError(task, exc_info = exc_info))
 
     def _sync_loop(self):
         # map from taskids to FutureTask objects
         active_tasks = {}
 
+        # consecutive ticks in which nothing happened
+        idle_ticks = 0
+
         while True:
+            # tasks taken from _tasks_to_submit in this tick
+            batch = []
+
             try:
                 if self._stop_queue_event.is_set():
+                    # fail the tasks left, so that .result() does not block
+                    self._fail_known_tasks(active_tasks, exception = 'queue was closed')
+                    # a tick may have cleared the event after close set it,
+                    # so we wake up any thread blocked in join here
+                    self._idle_event.set()
                     return
 
-                # if the queue is empty, we wait for tasks to be declared for
-                # submission, otherwise _queue.wait return immediately and we
-                # busy-wait
-                submit_timeout = 1
-                if len(active_tasks.keys()) > 0:
-                    submit_timeout = 0
+                # submit may have raced with setting _is_idle at the end of
+                # the previous tick
+                if not self._tasks_to_submit.empty():
+                    self._is_idle = False
+                    self._idle_event.clear()
 
-                # do the submits, if any
-                empty = False
-                while not empty:
-                    try:
-                        task = self._tasks_to_submit.get(True, submit_timeout)
-                        if not task.cancelled():
-                            with self._queue_lock:
-                                submit_timeout = 0
-                                taskid = self._queue.submit(task)
-                                task._set_queue(self)
-                                active_tasks[task.id] = task
-                        self._tasks_to_submit.task_done()
-                    except ThreadQueue.Empty:
-                        empty = True
-
-                # wait for any task
+                batch = _drain(self._tasks_to_submit)
+
+                wq_task = None
                 with self._queue_lock:
+                    # do the submits, if any
+                    for task in batch:
+                        if not task.cancelled():
+                            self._queue.submit(task)
+                            task._set_queue(self)
+                            active_tasks[task.id] = task
+
+                    # wait for any task. The lock has to be held, as it
+                    # serializes all the calls into the queue. work_queue_wait
+                    # turns a timeout of 0 into 1, so we ask for the smallest
+                    # timeout it honors, and calls routed through __getattr__
+                    # may wait up to a second for the lock.
                     if not self._queue.empty():
-                        task = self._queue.wait(1)
-                        if task:
-                            self._tasks_before_callbacks.put(task, False)
-                            del active_tasks[task.id]
+                        wq_task = self._queue.wait(1)
+                        if wq_task:
+                            self._tasks_before_callbacks.put(wq_task, False)
+                            active_tasks.pop(wq_task.id, None)
+                    elif active_tasks:
+                        # only tasks cancelled after submission are left
+                        active_tasks.clear()
 
                 if len(active_tasks) == 0 and self._tasks_to_submit.empty():
-                    self._join_event.set()
+                    self._is_idle = True
+                    self._idle_event.set()
+                else:
+                    self._is_idle = False
+                    self._idle_event.clear()
 
                 if self._local_worker:
                     self._local_worker.check_alive()
 
+                # With active tasks we never sleep, as the manager has to stay
+                # in _queue.wait to dispatch tasks and collect results, and
+                # that wait already blocks. Otherwise, if nothing happened in
+                # this tick we sleep until new tasks are submitted, so that we
+                # do not busy-wait. The sleep doubles from 10ms up to 1s while
+                # the queue stays idle, and submit cuts it short.
+                if batch or wq_task or active_tasks:
+                    idle_ticks = 0
+                else:
+                    self._submit_event.wait(min(1.0, 0.01 * (2 ** idle_ticks)))
+                    idle_ticks = min(idle_ticks + 1, 7)
+                    self._submit_event.clear()
+
             except Exception as e:
                 # on error, we set exception to all the known tasks so that .result() does not block
-                err = traceback.format_exc()
-                while not self._tasks_to_submit.empty():
-                    try:
-                        t = self._tasks_to_submit.get(False)
-                        t.set_exception(FutureTaskError(t, err))
-                        self._tasks_to_submit.task_done()
-                    except ThreadQueue.Empty:
-                        pass
-                while not self._tasks_before_callbacks.empty():
-                    try:
-                        t = self._tasks_before_callbacks.get(False)
-                        t.set_exception(FutureTaskError(t, err))
-                        self._tasks_before_callbacks.task_done()
-                    except ThreadQueue.Empty:
-                        pass
-                for t in active_tasks.values():
-                    t.set_exception(FutureTaskError(t, err))
-                active_tasks.clear()
+                # the traceback is only formatted if some future asks for it
+                exc_info = sys.exc_info()
+                self._fail_tasks(batch, exc_info = exc_info)
+                self._fail_known_tasks(active_tasks, exc_info = exc_info)
+                # the loop returns in the next iteration, there is no need to
+                # clear active_tasks
                 self._stop_queue_event.set()
 
+    # set the exception of the tasks not done yet. The arguments are passed to
+    # FutureTaskError.
+    def _fail_tasks(self, tasks, exception = None, exc_info = None):
+        for t in tasks:
+            if not t.done():
+                t.set_exception(FutureTaskError(t, exception = exception, exc_info = exc_info))
+
+    # fail the tasks waiting to be submitted, submitted, or waiting for their
+    # results to be set.
+    def _fail_known_tasks(self, active_tasks, exception = None, exc_info = None):
+        self._fail_tasks(_drain(self._tasks_to_submit), exception, exc_info)
+        self._fail_tasks(_drain(self._tasks_before_callbacks), exception, exc_info)
+        self._fail_tasks(active_tasks.values(), exception, exc_info)
+
+    ##
+    # Wait until all the submitted tasks have been collected.
+    #
+    # Returns True if the queue became empty, False on timeout or if the queue
+    # was terminated.
+    #
+    # @param self       Reference to the current work queue object.
+    # @param timeout    Maximum number of seconds to wait. None waits forever.
     def join(self, timeout=None):
-        now = time.time()
-        self._join_event.clear()
-        return self._join_event.wait(timeout)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while not self._stop_queue_event.is_set():
+            if self.empty():
+                return True
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+            self._idle_event.wait(remaining)
+
+        return False
 
-    def _terminate(self):
+    ##
+    # Stop the threads that submit and collect tasks, without waiting for
+    # them. Tasks not yet collected fail with a FutureTaskError, and new tasks
+    # cannot be submitted. Use the queue in a with statement to also wait for
+    # the threads and shut down the local worker.
+    #
+    # @param self       Reference to the current work queue object.
+    def close(self):
         self._stop_queue_event.set()
+        # wake up _sync_loop and any thread blocked in join. join checks
+        # _stop_queue_event, so empty() is not affected.
+        self._submit_event.set()
+        self._idle_event.set()
+
+        # the queue no longer needs to be terminated at exit (only in py3)
+        if hasattr(atexit, 'unregister'):
+            atexit.unregister(self._terminate)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._terminate(timeout = 5)
+
+    def _terminate(self, timeout = None):
+        self.close()
 
         for thread in [self._sync_loop, self._callback_loop]:
             try:
-                thread.join()
+                thread.join(timeout)
             except RuntimeError:
                 pass
 
@@ -223,12 +368,28 @@ class WorkQueueFutures(object):
             except Exception as e:
                 pass
 
+    # __del__ may run during interpreter shutdown, so we do not join the
+    # threads here.
     def __del__(self):
-        self._terminate()
+        try:
+            self._stop_queue_event.set()
+        except AttributeError:
+            # __init__ did not complete
+            pass
+
+
+# FutureTasks not yet submitted to a queue wait on this condition. They are
+# moved to the condition of their queue by FutureTask._set_queue.
+_unqueued_cond = threading.Condition()
 
 class FutureTask(work_queue.Task):
     valid_runtime_envs = ['conda', 'singularity']
 
+    # work_queue.Task keeps a __dict__ for its own attributes, the slots only
+    # cover the state of the future.
+    __slots__ = ('_queue', '_cancelled', '_exception', '_result', '_done',
+                 '_cond', '_callbacks', '_runtime_env_type')
+
     def __init__(self, command):
         super(FutureTask, self).__init__(command)
 
@@ -236,8 +397,11 @@ class FutureTask(work_queue.Task):
         self._cancelled = False
         self._exception = None
 
-        self._done_event = threading.Event()
-        self._callbacks = []
+        self._done      = False
+        self._cond      = _unqueued_cond
+
+        # set to None once the callbacks have been invoked
+        self._callbacks = deque()
 
         self._runtime_env_type = None
 
@@ -247,14 +411,53 @@ class FutureTask(work_queue.Task):
 
     def _set_queue(self, queue):
         self._queue = queue
+
+        cond = self._acquire_cond()
+        try:
+            self._cond = queue._cond
+            # waiters on the old condition retry with the new one
+            cond.notify_all()
+        finally:
+            cond.release()
+
         self.set_running_or_notify_cancel()
 
+    # _set_queue may replace the condition while we wait for its lock, so we
+    # retry until we hold the current one.
+    def _acquire_cond(self):
+        while True:
+            cond = self._cond
+            cond.acquire()
+            if cond is self._cond:
+                return cond
+            cond.release()
+
+    # returns True if the task is done within timeout seconds
+    def _wait_done(self, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            cond = self._acquire_cond()
+            try:
+                while not self._done and cond is self._cond:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                    cond.wait(remaining)
+                if self._done:
+                    return True
+            finally:
+                cond.release()
+
     def cancel(self):
         if self.queue:
             self.queue.cancel_by_taskid(self.id)
 
         self._cancelled = True
-        self._done_event.set()
         self._invoke_callbacks()
 
         return self.cancelled()
@@ -263,7 +466,7 @@ class FutureTask(work_queue.Task):
         return self._cancelled
 
     def done(self):
-        return self._done_event.is_set()
+        return self._done
 
     def running(self):
         return (self._queue is not None) and (not self.done())
@@ -272,11 +475,11 @@ class FutureTask(work_queue.Task):
         if self.cancelled():
             raise futures.CancelledError
 
-        # wait for task to be done event if not done already
-        self._done_event.wait(timeout)
-
-        if self.done():
-            if self._exception is not None:
+        # wait for task to be done if not done already
+        if self._wait_done(timeout):
+            if self.cancelled():
+                raise futures.CancelledError
+            elif self._exception is not None:
                 raise self._exception
             else:
                 return self._result
@@ -288,9 +491,9 @@ class FutureTask(work_queue.Task):
         if self.cancelled():
             raise futures.CancelledError
 
-        self._done_event.wait(timeout)
-
-        if self.done():
+        if self._wait_done(timeout):
+            if self.cancelled():
+                raise futures.CancelledError
             return self._exception
         else:
             raise futures.TimeoutError(timeout)
@@ -312,26 +515,64 @@ class FutureTask(work_queue.Task):
         called immediately.
         """
 
-        if self.done():
+        cond = self._acquire_cond()
+        try:
+            done = self._callbacks is None
+            if not done:
+                self._callbacks.append(fn)
+        finally:
+            cond.release()
+
+        if done:
             fn(self)
-        else:
-            self._callbacks.append(fn)
 
     def _invoke_callbacks(self):
-        self._done_event.set()
-        for fn in self._callbacks:
+        cond = self._acquire_cond()
+        try:
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, None
+            cond.notify_all()
+        finally:
+            cond.release()
+
+        self._run_callbacks(callbacks)
+
+    def _run_callbacks(self, callbacks):
+        # callbacks were already invoked, e.g., cancel after the result was set
+        if callbacks is None:
+            return
+
+        # popleft drops the references to the callbacks as they are called
+        while callbacks:
+            fn = callbacks.popleft()
             try:
                 fn(self)
             except Exception as e:
                 sys.stderr.write('Error when executing future object callback:\n')
                 traceback.print_exc()
 
-    def set_result_or_exception(self):
-        result = self._task.result
-        if result == work_queue.WORK_QUEUE_RESULT_SUCCESS and self.return_status == 0:
-            self.set_result(True)
+    # Set the result or exception from the finished work queue task, without
+    # waking up waiters. Called by _callback_loop with the queue condition
+    # held. Returns the callbacks to pass to _run_callbacks.
+    def _complete(self):
+        if self._task.result == _WQ_SUCCESS and self.return_status == 0:
+            self._result = True
         else:
-            self.set_exception(FutureTaskError(self))
+            self._exception = FutureTaskError(self)
+
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, None
+        return callbacks
+
+    def set_result_or_exception(self):
+        cond = self._acquire_cond()
+        try:
+            callbacks = self._complete()
+            cond.notify_all()
+        finally:
+            cond.release()
+
+        self._run_callbacks(callbacks)
 
     def set_running_or_notify_cancel(self):
         if self.cancelled():
@@ -428,49 +669,64 @@ class Worker(object):
         return self.check_alive()
 
 
+# messages for the task result states, used by FutureTaskError
+_state_to_msg = {
+    work_queue.WORK_QUEUE_RESULT_SUCCESS:             'Success',
+    work_queue.WORK_QUEUE_RESULT_INPUT_MISSING:       'Input file is missing',
+    work_queue.WORK_QUEUE_RESULT_OUTPUT_MISSING:      'Output file is missing',
+    work_queue.WORK_QUEUE_RESULT_STDOUT_MISSING:      'stdout is missing',
+    work_queue.WORK_QUEUE_RESULT_SIGNAL:              'Signal received',
+    work_queue.WORK_QUEUE_RESULT_RESOURCE_EXHAUSTION: 'Resources exhausted',
+    work_queue.WORK_QUEUE_RESULT_TASK_TIMEOUT:        'Task timed-out before completion',
+    work_queue.WORK_QUEUE_RESULT_UNKNOWN:             'Unknown error',
+    work_queue.WORK_QUEUE_RESULT_FORSAKEN:            'Internal error',
+    work_queue.WORK_QUEUE_RESULT_MAX_RETRIES:         'Maximum number of retries reached',
+    work_queue.WORK_QUEUE_RESULT_TASK_MAX_RUN_TIME:   'Task did not finish before deadline',
+    work_queue.WORK_QUEUE_RESULT_DISK_ALLOC_FULL:     'Disk allocation for the task is full'
+}
+
+
 class FutureTaskError(Exception):
-    _state_to_msg = {
-        work_queue.WORK_QUEUE_RESULT_SUCCESS:             'Success',
-        work_queue.WORK_QUEUE_RESULT_INPUT_MISSING:       'Input file is missing',
-        work_queue.WORK_QUEUE_RESULT_OUTPUT_MISSING:      'Output file is missing',
-        work_queue.WORK_QUEUE_RESULT_STDOUT_MISSING:      'stdout is missing',
-        work_queue.WORK_QUEUE_RESULT_SIGNAL:              'Signal received',
-        work_queue.WORK_QUEUE_RESULT_RESOURCE_EXHAUSTION: 'Resources exhausted',
-        work_queue.WORK_QUEUE_RESULT_TASK_TIMEOUT:        'Task timed-out before completion',
-        work_queue.WORK_QUEUE_RESULT_UNKNOWN:             'Unknown error',
-        work_queue.WORK_QUEUE_RESULT_FORSAKEN:            'Internal error',
-        work_queue.WORK_QUEUE_RESULT_MAX_RETRIES:         'Maximum number of retries reached',
-        work_queue.WORK_QUEUE_RESULT_TASK_MAX_RUN_TIME:   'Task did not finish before deadline',
-        work_queue.WORK_QUEUE_RESULT_DISK_ALLOC_FULL:     'Disk allocation for the task is full'
-    }
-
-    def __init__(self, task, exception = None):
+    def __init__(self, task, exception = None, exc_info = None):
         self.task  = task
 
         self.exit_status = None
         self.state       = None
-        self.exception   = None
 
-        if exception:
-            self.exception = exception
-        else:
+        self._exception = exception
+        self._exc_info  = exc_info
+
+        if not exception and not exc_info:
             self.exit_status = task.return_status
             self.state       = task._task.result
 
+    # the message of an error raised by the library, with the traceback
+    # from exc_info formatted on first access. Until then exc_info keeps the
+    # frames of the failing thread alive, e.g., _sync_loop and all the tasks
+    # in its active_tasks.
+    @property
+    def exception(self):
+        if self._exc_info:
+            self._exception = ''.join(traceback.format_exception(*self._exc_info))
+            self._exc_info  = None
+        return self._exception
+
+    @exception.setter
+    def exception(self, exception):
+        self._exception = exception
+        self._exc_info  = None
+
     def __str__(self):
         if self.exception:
             return str(self.exception)
 
-        msg = self._state_to_str()
+        msg = _state_to_msg.get(self.state)
         if not msg:
             return str(self.state)
 
-        if self.state != work_queue.WORK_QUEUE_RESULT_SUCCESS or self.exit_status == 0:
+        if self.state != _WQ_SUCCESS or self.exit_status == 0:
             return msg
         else:
             return 'Execution completed with exit status {}'.format(self.exit_status)
 
-    def _state_to_str(self):
-        return FutureTaskError._state_to_msg.get(self.state, None)
-
 # vim: set sts=4 sw=4 ts=4 expandtab ft=python:
@@ -29,11 +29,9 @@ for tag in alpha_order:
     q.submit(t)
 
 for tag in desired_tag_order:
-    while not q.empty():
-        t = q.wait_for_tag(tag, 10)
-        if t:
-            done_order.append(t.tag)
-            break
+    t = q.wait_for_tag(tag, 60)
+    if t:
+        done_order.append(t.tag)
 
 print("desired order: {}".format(desired_tag_order))
 print("returned order: {}".format(done_order))